@@ -4,10 +4,7 @@ This module implements the class EnergyMeter, to measure the energy consumption
 functions or code chunks, segregating their energy usage per component (CPU, DRAM, GPU and 
 Hard Disk). 
 """
-from datetime import datetime
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import pyRAPL
 from pynvml.smi import nvidia_smi
 
@@ -15,7 +12,6 @@ import subprocess
 import os
 import shlex
 import json
-import pandas as pd
 import time
 import threading
 
@@ -44,22 +40,25 @@ class ThreadGpuSamplingCmd(threading.Thread):
         """
         # We stop when self.stop is set to True.
         while self.stop == False:
-            # Get power draw.
-            pd = subprocess.check_output(shlex.split("nvidia-smi --query-gpu=power.draw --format=csv")).decode().split()
-            self.power_draw_history.append(float(pd[2]))
+            # Get power draw. We ask nvidia-smi for the bare number (no header nor units), so
+            # the first token of the output is already the power draw of the first GPU.
+            power_draw = subprocess.check_output(
+                shlex.split("nvidia-smi --query-gpu=power.draw --format=csv,noheader,nounits")
+            ).split()
+            self.power_draw_history.append(float(power_draw[0]))
             
             # Get utilization of python/python3 at each time step.
             o = subprocess.check_output(shlex.split("nvidia-smi pmon -c 1")).decode().split()
             processes_util = {o[i]: o[i-4] for i in range(25, len(o), 8)}
             activity = 0
-            if processes_util.get("python") and processes_util.get("python") != "-":
-                activity += float(processes_util.get("python"))
-            if processes_util.get("python3") and processes_util.get("python3") != "-":
-                activity += float(processes_util.get("python3"))
+            for comm in ("python", "python3"):
+                util = processes_util.get(comm, "-")
+                if util != "-":
+                    activity += float(util)
             self.activity_history.append(activity)
 
             # Sleep until next cycle.
-            time.sleep(ThreadGpuSampling.SECONDS_BETWEEN_SAMPLES)
+            time.sleep(ThreadGpuSamplingCmd.SECONDS_BETWEEN_SAMPLES)
 
 
 class ThreadGpuSamplingPyNvml(threading.Thread):
@@ -99,7 +98,10 @@ class EnergyMeter:
         library. RAPL is an API from Intel, which is also semi-compatible with
         AMD. RAPL on Intel has been shown to be accurate thanks to the usage of
         embedded sensors in the processor and memory while AMD uses performance
-        counters and is therefore, not so accurate.
+        counters and is therefore, not so accurate. Only the package domains
+        (one per socket) are read, the psys domain available on some Intel
+        machines is never read as it already includes the package and DRAM
+        energy, so adding up the components does not count it twice.
 
     - DRAM: the energy used by the memory is also measure with RAPL via pyRAPL.
         This might not be available for AMD processors and pre-Haswell Intel
@@ -116,7 +118,7 @@ class EnergyMeter:
         probe that tracks all the bytes read and written to disk. This probe is run 
         as a separate thread inside EnergyMeter. We then calculate the energy 
         consumption with the following formulae:
-        disk_active_time = (bytes_read + bytes_written) / DISK_SPEED
+        disk_active_time = min((bytes_read + bytes_written) / DISK_SPEED, total_meter_time)
         disk_idle_time = total_meter_time - disk_active_time
         total_energy = disk_active_time * DISK_ACTIVE_POWER +
                         disk_idle_time * DISK_IDLE_POWER
@@ -125,12 +127,19 @@ class EnergyMeter:
     """
 
     #################################### CONSTANTS ####################################
+    # Only python processes are accounted for, so we filter them in the probe itself instead
+    # of aggregating the IO of every process and discarding it afterwards.
     SCRIPT = (
-        "tracepoint:syscalls:sys_enter_write {@wbytes[comm] = sum(args->count);} "
-        "tracepoint:syscalls:sys_enter_read {@rbytes[comm] = sum(args->count);}"
+        'tracepoint:syscalls:sys_enter_write /comm == "python" || comm == "python3"/ '
+        "{@wbytes[comm] = sum(args->count);} "
+        'tracepoint:syscalls:sys_enter_read /comm == "python" || comm == "python3"/ '
+        "{@rbytes[comm] = sum(args->count);}"
     )
     ###################################################################################
 
+    # pyRAPL only needs to be set up once per process, so it is shared by all meters.
+    _rapl_ready = False
+
     def __init__(self, disk_avg_speed, disk_active_power, disk_idle_power, 
                  label=None, include_idle=False):
         """Initiates the variables required to meter the energy consumption of all
@@ -155,7 +164,9 @@ class EnergyMeter:
         self.include_idle = include_idle
 
         # Setup pyRAPL to measure CPU and DRAM.
-        pyRAPL.setup()
+        if not EnergyMeter._rapl_ready:
+            pyRAPL.setup()
+            EnergyMeter._rapl_ready = True
 
         # Setup disk parameters.
         self.disk_avg_speed = disk_avg_speed
@@ -175,9 +186,8 @@ class EnergyMeter:
         )
 
     def begin(self):
-        """Begin measuring the energy consumption. This sets the starting datetime and
-        reads the current RAPL counters. You should have start the bash script
-        start_meters.sh BEFORE calling this function.
+        """Begin measuring the energy consumption. This reads the current RAPL counters and
+        starts the bpftrace probe for the disk and the thread sampling the GPU.
         """
         # pyRAPL for CPU and DRAM.
         self.meter.begin()
@@ -195,127 +205,202 @@ class EnergyMeter:
     def end(self):
         """Finish the measurements and calculate results for CPU and DRAM. This sets the
         duration of the meter and reads again the RAPL counters, calculating how much energy
-        was used since the meter began. You should stop running the bash script
-        start_meters.sh AFTER calling this method.
+        was used since the meter began. It also stops the disk and GPU trackers and collects
+        their results.
         """
         # PyRAPL.
         self.meter.end()
+        # pyRAPL returns the duration in microseconds, we keep it in seconds.
+        self.duration_s = self.meter.result.duration * 1e-6
+        # pyRAPL returns the microjules (per socket), we convert them to jules once. Domains
+        # that are not recorded (e.g. DRAM on AMD) are None, so we keep them as empty arrays.
+        self.cpu_jules = self.__microjules_to_jules(self.meter.result.pkg)
+        self.dram_jules = self.__microjules_to_jules(self.meter.result.dram)
+
+        # Stop tracking GPU power usage. The thread finishes its last sample while bpftrace
+        # is being stopped, so we only wait for it once the disk output has been processed.
+        self.thread_gpu.stop = True
 
         # Kill bpftrace subprocess.
         subprocess.check_output(shlex.split("sudo kill {}".format(self.bpftrace_pid)))
 
-        # Stop tracking GPU power usage.
-        self.thread_gpu.stop = True
+        # Process bpftrace output, reading it line by line from the pipe.
+        self.total_rbytes, self.total_wbytes = self.__preprocess_bpftrace_output(
+            self.popen.stdout
+        )
+        self.popen.stdout.close()
+
+        # Wait for the last GPU sample to be stored.
+        self.thread_gpu.join()
 
-        # Process bpftrace output.
-        po = self.popen.stdout.read()
-        self.total_rbytes, self.total_wbytes = self.__preprocess_bpftrace_output(po)
+        # Convert the GPU samples once, so that every call to get_total_jules_gpu reuses them.
+        self.power_draw_history = self.__samples_to_array(self.thread_gpu.power_draw_history)
+        self.activity_history = self.__samples_to_array(self.thread_gpu.activity_history)
+
+    def __samples_to_array(self, samples):
+        """Convert the samples taken by the GPU sampling thread to a numpy array. Samples that
+        are not numbers (e.g. "N/A" when NVML does not support the query) are set to NaN.
+        :param samples: the list of samples.
+        :returns: a numpy array of floats with the same length as samples.
+        """
+        return np.array(
+            [s if isinstance(s, (int, float)) else np.nan for s in samples], dtype=np.float64
+        )
+
+    def __microjules_to_jules(self, microjules):
+        """Convert the per socket microjules returned by pyRAPL to jules.
+        :param microjules: the list of microjules per socket or None if pyRAPL did not
+            record the domain.
+        :returns: a numpy array with the jules per socket (empty if the domain was not
+            recorded).
+        """
+        if microjules is None:
+            return np.zeros(0, dtype=np.float64)
+        return np.multiply(microjules, 1e-6, dtype=np.float64)
 
     def __preprocess_bpftrace_output(self, bpftrace_output):
         """Preprocess the output of out bpftrace script and extract the bytes read and
         written. Attention: This must be changed if the bpftrace script changes!
-        :param bpftrace_output: the output of the bpftrace script.
+        :param bpftrace_output: an iterable over the lines (bytes) output by the bpftrace
+            script, e.g. its stdout pipe.
         :returns: total_rbytes (float), total_wbytes (float).
         """
-        bpftrace_output = bpftrace_output.decode()
-        if len(bpftrace_output.strip()) > 0:
-            po = bpftrace_output.split("\n")
-            rbytes = json.loads(po[3]).get("data").get("@rbytes")
-            wbytes = json.loads(po[4]).get("data").get("@wbytes")
-            # Do we want to measure other programs disk IO too?
-            total_rbytes = rbytes.get("python", 0) + rbytes.get("python3", 0)
-            total_wbytes = wbytes.get("python", 0) + wbytes.get("python3", 0)
-        else:
-            # bpftrace produced no output, which means there was no IO activity in the
-            # disk. This only happens when the code run has a very short duration.
-            total_rbytes = 0
-            total_wbytes = 0
+        # If bpftrace produced no output (or no map), there was no IO activity in the
+        # disk. This only happens when the code run has a very short duration.
+        rbytes = None
+        wbytes = None
+        for line in bpftrace_output:
+            line = line.decode().strip()
+            if len(line) == 0:
+                continue
+            # Maps are looked up by name, since empty maps are not printed and the line
+            # where each map is printed is not fixed.
+            data = json.loads(line).get("data", {})
+            rbytes = data.get("@rbytes", rbytes)
+            wbytes = data.get("@wbytes", wbytes)
+            # Stop reading as soon as both maps have been found.
+            if rbytes is not None and wbytes is not None:
+                break
+        rbytes = rbytes or {}
+        wbytes = wbytes or {}
+
+        # The probe already filters python processes, so all the entries are summed.
+        total_rbytes = sum(rbytes.values())
+        total_wbytes = sum(wbytes.values())
 
         return total_rbytes, total_wbytes
 
     def get_total_jules_disk(self):
         """We calculate the disk's energy consumption while the meter was running. For this,
-        we require the csv file that was generated by running the bash script start_meters.sh.
-        In this case, we utilize the speed and energy consumption parameters given when this
+        we use the bytes read and written by python processes as tracked by bpftrace, and
+        we utilize the speed and energy consumption parameters given when this
         object was initiated to estimate the disk's energy consumption. The formula used here
         was derived from:
         [1] Kansal, A., Zhao, F., Liu, J., Kothari, N., & Bhattacharya, A. A. (2010, June). 
         Virtual machine power metering and provisioning. In Proceedings of the 1st ACM 
         symposium on Cloud computing (pp. 39-50).
 
-        :param filename: the path to the csv file generated by start_meters.sh (or where the
-            output of disk_io.bt was saved.)
         :returns: the total jules used by the disk between meter.begin() and meter.end().
         """
         tot_bytes = self.total_rbytes + self.total_wbytes
+        # If there was no IO activity, only the idle energy (if requested) must be computed.
+        if tot_bytes == 0 and not self.include_idle:
+            return 0
+
+        return EnergyMeter.disk_energy(
+            tot_bytes, self.duration_s, self.disk_avg_speed, self.disk_active_power,
+            self.disk_idle_power, self.include_idle
+        )
 
-        # disk_active_time (in seconds) = (bytes_read + bytes_written) / DISK_SPEED
-        disk_active_time = tot_bytes / self.disk_avg_speed
+    @staticmethod
+    def disk_energy(tot_bytes, duration_s, disk_avg_speed, disk_active_power,
+                    disk_idle_power, include_idle=False):
+        """Estimate the disk's energy consumption with the formula described in
+        get_total_jules_disk. Only arithmetic is used, so tot_bytes and duration_s can also be
+        numpy arrays to compute the energy of many meters (e.g. a benchmark suite) at once.
+        :param tot_bytes: the bytes read and written to disk.
+        :param duration_s: the duration of the meter in seconds.
+        :param disk_avg_speed: the average read and write speed of the disk.
+        :param disk_active_power: the power used by the disk when active.
+        :param disk_idle_power: the average power used by the disk when idle.
+        :param include_idle: if energy used during idle time should be included.
+        :returns: the total jules used by the disk.
+        """
+        # disk_active_time (in seconds) = (bytes_read + bytes_written) / DISK_SPEED, which
+        # cannot be longer than the meter, otherwise the idle time would be negative.
+        disk_active_time = np.minimum(tot_bytes / disk_avg_speed, duration_s)
 
         # disk_idle_time (in seconds) = total_meter_time - disk_active_time
-        disk_idle_time = self.meter.result.duration * 1e-6 - disk_active_time
+        disk_idle_time = duration_s - disk_active_time
 
         # total_energy = disk_active_time * DISK_ACTIVE_POWER (+ disk_idle_time * DISK_IDLE_POWER)
-        te = disk_active_time * self.disk_active_power
-        if self.include_idle:
-            te += disk_idle_time * self.disk_idle_power
+        te = disk_active_time * disk_active_power
+        if include_idle:
+            te += disk_idle_time * disk_idle_power
         return te
 
-    def get_total_jules_cpu(self):
+    def get_total_jules_cpu(self, per_socket=False):
         """We obtain the total jules consumed by the CPU from pyRAPL.
-        :returns: the total jules used by the CPU between meter.begin() and meter.end().
+        :param per_socket: if True, an array with the jules used in each socket is returned.
+        :returns: the total jules used by the CPU between meter.begin() and meter.end(),
+            0.0 (or an empty array if per_socket) if pyRAPL could not record it.
         """
-        # pyRAPL returns the microjules, so we convert them to jules.
-        return np.array(self.meter.result.pkg) * 1e-6
+        if per_socket:
+            return self.cpu_jules
+        return float(self.cpu_jules.sum())
 
-    def get_total_jules_dram(self):
+    def get_total_jules_dram(self, per_socket=False):
         """We obtain the total jules consumed by the DRAM from pyRAPL.
-        :returns: the total jules used by the DRAM between meter.begin() and meter.end().
+        :param per_socket: if True, an array with the jules used in each socket is returned.
+        :returns: the total jules used by the DRAM between meter.begin() and meter.end(),
+            0.0 (or an empty array if per_socket) if pyRAPL could not record it.
         """
-        # pyRAPL returns the microjules, so we convert them to jules.
-        return np.array(self.meter.result.dram) * 1e-6
+        if per_socket:
+            return self.dram_jules
+        return float(self.dram_jules.sum())
 
     def get_total_jules_gpu(self):
         """We calculate the GPU's energy consumption while the meter was running. For this,
-        we require the csv file that was generated by running the bash script start_meters.sh.
+        we use the power draw samples taken by the GPU sampling thread.
         This is calculated as the mean power used between meter.begin() and meter.end() times
         the total time in seconds.
-        :param filename: the path to the csv file generated by start_meters.sh (or the file
-            generated by gpu_stats.sh.)
         :returns: the total jules used by the GPU between meter.begin() and meter.end().
         """
-        if len(self.thread_gpu.activity_history) == 0:
+        if len(self.activity_history) == 0:
             return 0
 
-        # total_energy = mean_GPU_power_draw * min(meter_duration_ns * 1e-6, GPU_active_time_s)
+        # total_energy = mean_GPU_power_draw * min(meter_duration_s, GPU_active_time_s)
         if self.include_idle:
             # We use the mean power draw thoughout the whole time (including idle time.)
-            mean_p = np.mean(self.thread_gpu.power_draw_history)
-            te = mean_p * self.meter.result.duration * 1e-6
-        else:
-            # First, check if there was any activity, otherwise return 0.
-            if sum(self.thread_gpu.activity_history) == 0:
+            valid_pdh = self.power_draw_history[~np.isnan(self.power_draw_history)]
+            if valid_pdh.size == 0:
                 return 0
-                
+            mean_p = valid_pdh.mean()
+            te = mean_p * self.duration_s
+        else:
             # We calculate the mean power draw during intervals of time at which
             # python or python3 was active on the GPU.
-            pdh = self.thread_gpu.power_draw_history
-            ah = self.thread_gpu.activity_history
+            pdh = self.power_draw_history
+            ah = self.activity_history
             assert len(pdh) == len(ah), "Power draw and activity history have diff lengths!"
 
+            # If there was no activity (or no valid power draw), return 0.
+            active_pdh = pdh[(ah > 0) & ~np.isnan(pdh)]
+            if active_pdh.size == 0:
+                return 0
+
             sbs = self.thread_gpu.SECONDS_BETWEEN_SAMPLES
-            mean_p = np.mean([pdh[i] for i in range(len(pdh)) if ah[i] > 0])
+            mean_p = active_pdh.mean()
             # We estimate the task was running for length of samples * the time between samples,
             # or the duration of the meter if this was shorter. Our error in this estimation is
             # bounded to (t - 2*SECONDS_BETWEEN_SAMPLES, t + SECONDS_BETWEEN_SAMPLES).
-            te = mean_p * min(self.meter.result.duration * 1e-6, len(ah)*sbs)
+            te = mean_p * min(self.duration_s, len(ah)*sbs)
             
         return te
 
     def get_total_jules_per_component(self):
         """This returns the total energy consumption in jules between meter.begin() and
         meter.end() segregated by component (CPU, DRAM, GPU and disk).
-        :param foldername: the path to the folder generated by start_meters.sh.
         :returns: a dictionary with the total jules used by each component.
         """
         cpu = self.get_total_jules_cpu()
@@ -333,21 +418,17 @@ class EnergyMeter:
     def plot_total_jules_per_component(self, include_total=True):
         """This plots the total energy consumption in jules between meter.begin() and
         meter.end() and the total consumption by each component (CPU, DRAM, GPU and disk).
-        :param foldername: the path to the folder generated by start_meters.sh.
+        :param include_total: if the sum of all components should be plotted too.
         """
-        data = self.get_total_jules_per_component()
+        # matplotlib is only imported when plotting, as loading it is slow.
+        import matplotlib.pyplot as plt
+
+        data = {k: float(v) for k, v in self.get_total_jules_per_component().items()}
         if include_total:
-            data["total"] = (
-                np.sum(data.get("cpu"))
-                + np.sum(data.get("dram"))
-                + data.get("disk")
-                + data.get("gpu")
-            )
-        keys = data.keys()
-        values = [float(val) for val in data.values()]
+            data["total"] = sum(data.values())
 
         fig, ax = plt.subplots()
-        bars = ax.bar(list(keys), values)
+        bars = ax.bar(list(data.keys()), list(data.values()))
         ax.bar_label(bars)
         plt.xlabel("Components")
         plt.ylabel("Jules")